@@ -32,8 +32,10 @@ def CapsNet(input_shape, n_class, routings, batch_size):
     out_caps = Length(name='capsnet')(digitcaps)
 
     y = layers.Input(shape=(n_class,))
-    masked_by_y = Mask()([digitcaps, y])  
-    masked = Mask()(digitcaps) 
+    mask_layer = Mask()
+    masked_by_y = mask_layer([digitcaps, y])
+    masked = mask_layer(digitcaps)
+    flatten = layers.Flatten()
 
     decoder = models.Sequential(name='decoder')
     decoder.add(layers.Dense(64, activation=layers.LeakyReLU(alpha=0.3), input_dim=8 * n_class)) 
@@ -42,14 +44,14 @@ def CapsNet(input_shape, n_class, routings, batch_size):
     decoder.add(layers.Reshape(target_shape=input_shape, name='out_recon'))
 
     # Models for training and evaluation (prediction)
-    train_model = models.Model([x, y], [out_caps, decoder(masked_by_y)])
-    eval_model = models.Model(x, [out_caps, decoder(masked)])
+    train_model = models.Model([x, y], [out_caps, decoder(flatten(masked_by_y))])
+    eval_model = models.Model(x, [out_caps, decoder(flatten(masked))])
 
     # manipulate model
     noise = layers.Input(shape=(n_class, 8)) #16
     noised_digitcaps = layers.Add()([digitcaps, noise])
-    masked_noised_y = Mask()([noised_digitcaps, y])
-    manipulate_model = models.Model([x, y, noise], decoder(masked_noised_y))
+    masked_noised_y = mask_layer([noised_digitcaps, y])
+    manipulate_model = models.Model([x, y, noise], decoder(flatten(masked_noised_y)))
     return train_model, eval_model, manipulate_model
 
 
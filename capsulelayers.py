@@ -1,3 +1,4 @@
+import functools
 import tensorflow.keras.backend as K
 import tensorflow as tf
 from tensorflow.keras import initializers, layers
@@ -10,8 +11,9 @@ class Length(layers.Layer):
     inputs: shape=[None, num_vectors, dim_vector]
     output: shape=[None, num_vectors]
     """
+    @tf.function(jit_compile=True)
     def call(self, inputs, **kwargs):
-        return K.sqrt(K.sum(K.square(inputs), -1) + K.epsilon())
+        return tf.sqrt(tf.reduce_sum(tf.square(inputs), axis=-1) + K.epsilon())
 
     def compute_output_shape(self, input_shape):
         return input_shape[:-1]
@@ -24,45 +26,73 @@ class Length(layers.Layer):
 class Mask(layers.Layer):
     """
     Mask a Tensor with shape=[None, num_capsule, dim_vector] either by the capsule with max length or by an additional 
-    input mask. Except the max-length capsule (or specified capsule), all vectors are masked to zeros. Then flatten the
-    masked Tensor.
+    input mask. Except the max-length capsule (or specified capsule), all vectors are masked to zeros. The masked
+    Tensor keeps its shape, flatten it (e.g. with `layers.Flatten`) before feeding it to a Dense decoder.
     For example:
         ```
         x = keras.layers.Input(shape=[8, 3, 2])  # batch_size=8, each sample contains 3 capsules with dim_vector=2
         y = keras.layers.Input(shape=[8, 3])  # True labels. 8 samples, 3 classes, one-hot coding.
-        out = Mask()(x)  # out.shape=[8, 6]
+        out = Mask()(x)  # out.shape=[8, 3, 2]
         # or
-        out2 = Mask()([x, y])  # out2.shape=[8,6]. Masked with true labels y. Of course y can also be manipulated.
+        out2 = Mask()([x, y])  # out2.shape=[8, 3, 2]. Masked with true labels y. Of course y can also be manipulated.
+        # or
+        out3 = Mask(gather=True)([x, y])  # out3.shape=[8,2]. Only the capsule selected by argmax(y) is kept.
         ```
+    :param gather: if True, return only the selected capsule, shape=[None, dim_vector], instead of the masked
+                   Tensor. A soft (manipulated) mask is then reduced to its argmax.
     """
+    def __init__(self, gather=False, **kwargs):
+        super(Mask, self).__init__(**kwargs)
+        self.gather = gather
+
+    def build(self, input_shape):
+        # number of capsules, i.e. depth of the one-hot mask, known statically from the capsules' shape
+        if isinstance(input_shape, list):  # true label provided
+            input_shape = input_shape[0]
+        self.num_capsule = input_shape[-2]
+        self.built = True
+
     def call(self, inputs, **kwargs):
         if type(inputs) is list:  # true label is provided with shape = [None, n_classes], i.e. one-hot code.
             assert len(inputs) == 2
             inputs, mask = inputs
+            indices = tf.argmax(mask, axis=1) if self.gather else None
         else:  # if no true label, mask by the max length of capsules. Mainly used for prediction
-            # compute lengths of capsules
-            x = K.sqrt(K.sum(K.square(inputs), -1))
-            # generate the mask which is a one-hot code.
-            # mask.shape=[None, n_classes]=[None, num_capsule]
-            mask = K.one_hot(indices=K.argmax(x, 1), num_classes=x.get_shape().as_list()[1])
+            # compute squared lengths of capsules, sqrt is monotonic so argmax is unchanged
+            x = tf.reduce_sum(tf.square(inputs), axis=-1)
+            indices = tf.argmax(x, axis=1)
+            if not self.gather:
+                # generate the mask which is a one-hot code.
+                # mask.shape=[None, n_classes]=[None, num_capsule]
+                mask = tf.one_hot(indices=indices, depth=self.num_capsule, dtype=inputs.dtype)
+
+        if self.gather:
+            # pick the selected capsule of each sample instead of zeroing all the others
+            # masked.shape=[None, dim_capsule]
+            return tf.gather(inputs, indices, batch_dims=1)
 
         # inputs.shape=[None, num_capsule, dim_capsule]
         # mask.shape=[None, num_capsule]
-        # masked.shape=[None, num_capsule * dim_capsule]
-        masked = K.batch_flatten(inputs * K.expand_dims(mask, -1))
+        # masked.shape=[None, num_capsule, dim_capsule]
+        masked = inputs * mask[..., None]
         return masked
 
     def compute_output_shape(self, input_shape):
-        if type(input_shape[0]) is tuple:  # true label provided
-            return tuple([None, input_shape[0][1] * input_shape[0][2]])
-        else:  # no true label provided
-            return tuple([None, input_shape[1] * input_shape[2]])
+        if isinstance(input_shape, list):  # true label provided
+            input_shape = input_shape[0]
+        if self.gather:
+            return tuple([None, input_shape[2]])
+        return tuple([None, input_shape[1], input_shape[2]])
 
     def get_config(self):
-        config = super(Mask, self).get_config()
-        return config
+        config = {
+            'gather': self.gather
+        }
+        base_config = super(Mask, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
 
 
+@tf.function(jit_compile=True)
 def squash(vectors, axis=-1):
     """
     The non-linear activation used in Capsules. It "squashes" large vectors to near 1 and small vectors to 0
@@ -70,9 +100,52 @@ def squash(vectors, axis=-1):
     :param axis: the axis to squash
     :return: a Tensor with same shape as input vectors
     """
-    s_squared_norm = K.sum(K.square(vectors), axis, keepdims=True)
-    scale = s_squared_norm / (1 + s_squared_norm) / K.sqrt(s_squared_norm + K.epsilon())
-    return scale * vectors
+    # the norm is computed in float32 even under a mixed precision policy, epsilon and the
+    # gradient of rsqrt near zero do not fit in half precision
+    v32 = tf.cast(vectors, tf.float32)
+    s_squared_norm = tf.reduce_sum(tf.square(v32), axis=axis, keepdims=True)
+    scale = s_squared_norm * tf.math.rsqrt(s_squared_norm + K.epsilon()) / (1.0 + s_squared_norm)
+    return tf.cast(scale * v32, vectors.dtype)
+
+
+def _route(inputs_hat, routings):
+    """
+    Dynamic routing between capsules. `routings` is a Python int, so the loop is unrolled at trace time and XLA
+    compiles all the iterations into a few fused kernels. CapsuleLayer wraps it in a `tf.function` in `build`.
+    :param inputs_hat: predicted output vectors, shape=[None, num_capsule, input_num_capsule, dim_capsule]
+    :param routings: number of iterations for the routing algorithm
+    :return: output capsules, shape=[None, num_capsule, dim_capsule]
+    """
+    # The prior for coupling coefficient, b, starts as zeros, so the softmax of the
+    # first iteration is uniform, c = 1 / num_capsule. Instead of allocating a zero b
+    # it is only created by the first agreement update.
+    #  b.shape = [None, num_capsule, input_num_capsule].
+    num_capsule = inputs_hat.shape[1]
+
+    for i in range(routings):
+        # Compute the weighted sum of all the predicted output vectors along
+        # the input_num_capsule axis, then apply squash along the dim_capsule.
+        #  c.shape =  [batch_size, num_capsule, input_num_capsule]
+        #  inputs_hat.shape=[None, num_capsule, input_num_capsule, dim_capsule]
+        #  outputs.shape=[None, num_capsule, dim_capsule]
+        if i == 0:
+            outputs = tf.reduce_sum(inputs_hat, axis=2) / num_capsule
+        else:
+            # Apply softmax to the axis with `num_capsule`
+            c = tf.nn.softmax(b, axis=1)
+            outputs = tf.einsum('bij,bijk->bik', c, inputs_hat)
+        outputs = squash(outputs)  # [None, num_capsule, dim_capsule]
+
+        if i < routings - 1:
+            # Update the prior b with the agreement (dot product over
+            # dim_capsule) between the outputs and the inputs_hat.
+            #  outputs.shape =  [None, num_capsule, dim_capsule]
+            #  inputs_hat.shape=[None, num_capsule, input_num_capsule, dim_capsule]
+            #  agreement.shape=[None, num_capsule, input_num_capsule]
+            agreement = tf.einsum('bik,bijk->bij', outputs, inputs_hat)
+            b = agreement if i == 0 else tf.add(b, agreement)
+
+    return outputs
 
 
 class CapsuleLayer(layers.Layer):
@@ -106,73 +179,43 @@ class CapsuleLayer(layers.Layer):
                                  initializer=self.kernel_initializer,
                                  name='W')
 
+        # Routing function with the capsule shapes pinned, so it is traced once and compiled with XLA.
+        # The batch axis is left dynamic, the last batch of predict() may be smaller than batch_size.
+        self._route = tf.function(functools.partial(_route, routings=self.routings),
+                                  input_signature=[tf.TensorSpec(shape=[None, self.num_capsule,
+                                                                        self.input_num_capsule, self.dim_capsule],
+                                                                 dtype=self.compute_dtype)],
+                                  jit_compile=True)
+
         self.built = True
 
 
     def call(self, inputs, training=None):
-        # Expand the input in axis=1, tile in that axis to num_capsule, and 
-        # expands another axis at the end to prepare the multiplication with W.
+        # Compute `W * inputs` for every (output capsule, input capsule) pair as one
+        # batched GEMM over input_num_capsule. Each input capsule has its own
+        # [input_dim_capsule, num_capsule * dim_capsule] slice of W, so for each of them
+        # the whole batch is multiplied at once:
         #  inputs.shape=[None, input_num_capsule, input_dim_capsule]
-        #  inputs_expand.shape=[None, 1, input_num_capsule, input_dim_capsule]
-        #  inputs_tiled.shape=[None, num_capsule, input_num_capsule, 
-        #                            input_dim_capsule, 1]
-
-        inputs_expand = tf.expand_dims(inputs, 1)
-        inputs_tiled  = tf.tile(inputs_expand, [1, self.num_capsule, 1, 1])
-        inputs_tiled  = tf.expand_dims(inputs_tiled, 4)
-
-        # Compute `W * inputs` by scanning inputs_tiled on dimension 0 (map_fn).
-        # - Use matmul (without transposing any element). Note the order!
-        # Thus:
-        #  x.shape=[num_capsule, input_num_capsule, input_dim_capsule, 1]
-        #  W.shape=[num_capsule, input_num_capsule, dim_capsule,input_dim_capsule]
-        # Regard the first two dimensions as `batch` dimension,
-        # then matmul: [dim_capsule, input_dim_capsule] x [input_dim_capsule, 1]-> 
-        #              [dim_capsule, 1].
-        #  inputs_hat.shape=[None, num_capsule, input_num_capsule, dim_capsule, 1]
-        
-        inputs_hat = tf.map_fn(lambda x: tf.matmul(self.W, x), elems=inputs_tiled)     
-
-        # Begin: Routing algorithm ----------------------------------------------#
-        # The prior for coupling coefficient, initialized as zeros.
-        #  b.shape = [None, self.num_capsule, self.input_num_capsule, 1, 1].
-        b = tf.zeros(shape=[tf.shape(inputs_hat)[0], self.num_capsule, 
-                            self.input_num_capsule, 1, 1])
-
+        #    -> [input_num_capsule, None, input_dim_capsule]
+        #  W.shape=[num_capsule, input_num_capsule, dim_capsule, input_dim_capsule]
+        #    -> [input_num_capsule, input_dim_capsule, num_capsule * dim_capsule]
+        #  matmul -> [input_num_capsule, None, num_capsule * dim_capsule]
+        #  inputs_hat.shape=[None, num_capsule, input_num_capsule, dim_capsule]
+        # W keeps its [num_capsule, input_num_capsule, dim_capsule, input_dim_capsule] layout
+        # so saved weights still load. With a mixed precision policy W is kept in float32
+        # and only cast to the compute dtype here, the transform and the routing then run
+        # in half precision.
+        W = tf.cast(self.W, inputs.dtype)
+        W = tf.reshape(tf.transpose(W, [1, 3, 0, 2]),
+                       [self.input_num_capsule, self.input_dim_capsule, self.num_capsule * self.dim_capsule])
+        inputs_hat = tf.matmul(tf.transpose(inputs, [1, 0, 2]), W)
+        inputs_hat = tf.reshape(inputs_hat, [self.input_num_capsule, -1, self.num_capsule, self.dim_capsule])
+        inputs_hat = tf.transpose(inputs_hat, [1, 2, 0, 3])
+
+        # Routing algorithm, outputs.shape=[None, num_capsule, dim_capsule]
         assert self.routings > 0, 'The routings should be > 0.'
-        for i in range(self.routings):
-            # Apply softmax to the axis with `num_capsule`
-            #  c.shape=[batch_size, num_capsule, input_num_capsule, 1, 1]
-            c = layers.Softmax(axis=1)(b)
-
-            # Compute the weighted sum of all the predicted output vectors.
-            #  c.shape =  [batch_size, num_capsule, input_num_capsule, 1, 1]
-            #  inputs_hat.shape=[None, num_capsule, input_num_capsule,dim_capsule,1]
-            # The function `multiply` will broadcast axis=3 in c to dim_capsule.
-            #  outputs.shape=[None, num_capsule, input_num_capsule, dim_capsule, 1]
-            # Then sum along the input_num_capsule
-            #  outputs.shape=[None, num_capsule, 1, dim_capsule, 1]
-            # Then apply squash along the dim_capsule
-            outputs = tf.multiply(c, inputs_hat)
-            outputs = tf.reduce_sum(outputs, axis=2, keepdims=True)
-            outputs = squash(outputs, axis=-2)  # [None, 10, 1, 16, 1]
-
-            if i < self.routings - 1:
-                # Update the prior b.
-                #  outputs.shape =  [None, num_capsule, 1, dim_capsule, 1]
-                #  inputs_hat.shape=[None,num_capsule,input_num_capsule,dim_capsule,1]
-                # Multiply the outputs with the weighted_inputs (inputs_hat) and add  
-                # it to the prior b.  
-                outputs_tiled = tf.tile(outputs, [1, 1, self.input_num_capsule, 1, 1])
-                agreement = tf.matmul(inputs_hat, outputs_tiled, transpose_a=True)
-                b = tf.add(b, agreement)
-
-        # End: Routing algorithm ------------------------------------------------#
-        # Squeeze the outputs to remove useless axis:
-        #  From  --> outputs.shape=[None, num_capsule, 1, dim_capsule, 1]
-        #  To    --> outputs.shape=[None, num_capsule,    dim_capsule]
-        outputs = tf.squeeze(outputs, [2, 4])
-        return outputs
+        outputs = self._route(inputs_hat)
+        return tf.cast(outputs, self.dtype)
 
     def compute_output_shape(self, input_shape):
         return tuple([None, self.num_capsule, self.dim_capsule])
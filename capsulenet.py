@@ -20,13 +20,15 @@ K.set_image_data_format('channels_last')
 
 IMG_SIZE=32
 
-def CapsNet(input_shape, n_class, routings, batch_size):
+def CapsNet(input_shape, n_class, routings, batch_size, gather_mask=False):
     """
     Capsule network for Aloe Vera Dataset.
     :param input_shape: data shape, 3d, [width, height, channels]
     :param n_class: number of classes
     :param routings: number of routing iterations
     :param batch_size: size of batch
+    :param gather_mask: feed the decoder only the selected capsule instead of all the masked capsules. The decoder
+                        input shrinks from 8*n_class to 8, so weights trained without it can not be loaded.
     :return: Two Keras Models, one for training, one for evaluation.
     """
     x = layers.Input(shape=input_shape, batch_size=batch_size)
@@ -43,29 +45,31 @@ def CapsNet(input_shape, n_class, routings, batch_size):
 
 
     # Layer 4: This layer replaces each capsule with its length. Just to match the true label's shape.
-    out_caps = Length(name='capsnet')(digitcaps)
+    out_caps = Length(name='capsnet', dtype='float32')(digitcaps)
 
     # Decoder network.
     y = layers.Input(shape=(n_class,))
-    masked_by_y = Mask()([digitcaps, y])  # The true label is used to mask the output of capsule layer. For training
-    masked = Mask()(digitcaps)  # Mask using the capsule with maximal length. For prediction
+    mask_layer = Mask(gather=gather_mask)  # Mask has no weights, one instance is shared by all the models
+    masked_by_y = mask_layer([digitcaps, y])  # The true label is used to mask the output of capsule layer. For training
+    masked = mask_layer(digitcaps)  # Mask using the capsule with maximal length. For prediction
+    flatten = layers.Flatten()  # Flatten the masked capsules into the decoder input, shared like mask_layer
 
     #Decoder model in training and prediction
     decoder = models.Sequential(name='decoder')
-    decoder.add(layers.Dense(64, activation=layers.LeakyReLU(alpha=0.3), input_dim=8 * n_class))
+    decoder.add(layers.Dense(64, activation=layers.LeakyReLU(alpha=0.3), input_dim=8 if gather_mask else 8 * n_class))
     decoder.add(layers.Dense(128, activation=layers.LeakyReLU(alpha=0.3)))
-    decoder.add(layers.Dense(np.prod(input_shape), activation='sigmoid'))
-    decoder.add(layers.Reshape(target_shape=input_shape, name='out_recon'))
+    decoder.add(layers.Dense(np.prod(input_shape), activation='sigmoid', dtype='float32'))
+    decoder.add(layers.Reshape(target_shape=input_shape, name='out_recon', dtype='float32'))
 
     # Models for training and evaluation (prediction)
-    train_model = models.Model([x, y], [out_caps, decoder(masked_by_y)])
-    eval_model = models.Model(x, [out_caps, decoder(masked)])
+    train_model = models.Model([x, y], [out_caps, decoder(flatten(masked_by_y))])
+    eval_model = models.Model(x, [out_caps, decoder(flatten(masked))])
 
     # manipulate model
     noise = layers.Input(shape=(n_class, 8)) #16
     noised_digitcaps = layers.Add()([digitcaps, noise])
-    masked_noised_y = Mask()([noised_digitcaps, y])
-    manipulate_model = models.Model([x, y, noise], decoder(masked_noised_y))
+    masked_noised_y = mask_layer([noised_digitcaps, y])
+    manipulate_model = models.Model([x, y, noise], decoder(flatten(masked_noised_y)))
     return train_model, eval_model, manipulate_model
 
 
@@ -274,9 +278,16 @@ if __name__ == "__main__":
                         help="Digit to manipulate")
     parser.add_argument('-w', '--weights', default=None,
                         help="The path of the saved weights. Should be specified when testing")
+    parser.add_argument('--gather_mask', action='store_true',
+                        help="Feed the decoder only the selected capsule. Not compatible with weights trained without it")
+    parser.add_argument('--mixed_precision', default=None, choices=['mixed_float16', 'mixed_bfloat16'],
+                        help="Keras mixed precision policy. Weights stay in float32, layers compute in half precision")
     args = parser.parse_args()
     print(args)
 
+    if args.mixed_precision is not None:
+        tf.keras.mixed_precision.set_global_policy(args.mixed_precision)
+
     if not os.path.exists(args.save_dir):
         os.makedirs(args.save_dir)
 
@@ -287,7 +298,8 @@ if __name__ == "__main__":
     model, eval_model, manipulate_model = CapsNet(input_shape=x_train.shape[1:],
                                                   n_class=len(np.unique(np.argmax(y_train, 1))),
                                                   routings=args.routings,
-                                                  batch_size=args.batch_size)
+                                                  batch_size=args.batch_size,
+                                                  gather_mask=args.gather_mask)
     model.summary()
 
     # train or test
@@ -40,14 +40,12 @@ def combine_images(generated_images, height=None, width=None):
         width = int(math.ceil(float(num)/height))
 
     shape = generated_images.shape[1:3]
-    image = np.zeros((height*shape[0], width*shape[1]),
-                     dtype=generated_images.dtype)
-    for index, img in enumerate(generated_images):
-        i = int(index/width)
-        j = index % width
-        image[i*shape[0]:(i+1)*shape[0], j*shape[1]:(j+1)*shape[1]] = \
-            img[:, :, 0]
-    return image
+    # pad with blank images to fill the grid, then lay the [height, width] grid of
+    # images out row by row with a single reshape/transpose
+    padding = np.zeros((height*width - num,) + shape, dtype=generated_images.dtype)
+    images = np.concatenate([generated_images[:, :, :, 0], padding])
+    image = images.reshape(height, width, shape[0], shape[1]).transpose(0, 2, 1, 3)
+    return image.reshape(height*shape[0], width*shape[1])
 
 if __name__=="__main__":
     plot_log('result/log.csv')